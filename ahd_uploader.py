@@ -7,16 +7,18 @@ Usage generally follows two steps: the preparation of an upload form, and subseq
 
 Preparation involves the creation of a torrent and the filling out of the associated information in AHD's upload form,
 including mediainfo and screenshots. Basic functionality for automatically detecting some other info
-(group, codec, etc.) is provided but not recommended. The result of this step is a serialized Python dictionary
-representing a completed upload form.
+(group, codec, etc.) is provided but not recommended. The result of this step is a JSON file representing a completed
+upload form. The form refers to the created torrent by its path rather than containing it,
+so the torrent must not be moved or deleted before uploading.
 You may also examine the prepared form before uploading using this tool.
-Advanced users could edit this form in Python, but such functionality is not currently provided.
+Advanced users could edit this form by hand, but no further tooling for doing so is currently provided.
 
 Upon finishing the preparation, the form may be uploaded. Uploading currently requires a cookies file, as logging in on
 your behalf is made difficult by a captcha. The cookies file is expected to be in the standard Netscape format
 (as used by wget, curl, etc.) and may be extracted from your browser using various extensions.
 If uploading is successful, the command should output a direct link to the torrent file from AHD; if that doesn't work,
 it will output a URL to the media page.
+Both steps may also be run at once with prepare-and-upload, in which case the form is never saved.
 
 The author of this script is not a member of staff and provides no guarantee that usage of the script will not lead
 to violation of site rules either directly or indirectly.
@@ -27,9 +29,14 @@ Usage:
         [--imdb=<imdb> --media-type=<media_type> --type=<type> --group=<group> --codec=<codec>]
         [--user-release --special-edition=<edition_information>]
         [--num-screens=<num_screens>]
-        [--overwrite-existing-torrent]
+        [--overwrite-existing-torrent --mediainfo-fast]
     ahd_uploader.py examine <input_form>
     ahd_uploader.py upload <input_form> --cookies=<cookie_file> [--delete-on-success]
+    ahd_uploader.py prepare-and-upload <media> --passkey=<passkey> --cookies=<cookie_file>
+        [--imdb=<imdb> --media-type=<media_type> --type=<type> --group=<group> --codec=<codec>]
+        [--user-release --special-edition=<edition_information>]
+        [--num-screens=<num_screens>]
+        [--overwrite-existing-torrent --mediainfo-fast]
 
 Options:
   -h --help     Show this screen.
@@ -55,6 +62,8 @@ Options:
 
   --num-screens=<num_screens>   Number of screenshots to upload and include in description [default: 4]
   --overwrite-existing-torrent  By default, if a torrent exists in the expected path, it is used. Use to overwrite.
+  --mediainfo-fast  Have mediainfo parse as little of the file as possible. Much faster for some files
+                    (e.g. with closed captions), but some fields may be missing from the result.
 
 
   <input_form>     Path to previously prepared upload form to examine or upload.
@@ -63,25 +72,55 @@ Options:
 
 """
 
+import base64
+import codecs
+import functools
 import http.cookiejar
-import pickle
-import shutil
+import json
+import os
+import re
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
 from pathlib import Path
 from pprint import pprint
 
+import lxml.etree
+import lxml.html
 import pendulum
 import requests
 from docopt import docopt
 from guessit import guessit
 from imdb import IMDb
-from requests_html import HTML
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 KNOWN_EDITIONS = ["Director's Cut", "Unrated", "Extended Edition", "2 in 1", "The Criterion Collection"]
 TYPES = ['Movies', 'TV-Shows']
 MEDIA_TYPES = ['Blu-ray', 'HD-DVD', 'HDTV', 'WEB-DL', 'WEBRip', 'DTheater', 'XDCAM', 'UHD Blu-ray']
+# Spellings found in release names that indicate a media type other than by its own name.
+MEDIA_TYPE_ALIASES = {'UHD.BluRay': 'UHD Blu-ray', 'BluRay': 'Blu-ray'}
 CODECS = ['x264', 'VC-1 Remux', 'h.264 Remux', 'MPEG2 Remux', 'h.265 Remux', 'x265']
+# Alternatives are longest first, so that e.g. 'UHD Blu-ray' wins over 'Blu-ray' when both match at the same position.
+MEDIA_TYPE_RE = re.compile('|'.join(map(re.escape, sorted(MEDIA_TYPES + list(MEDIA_TYPE_ALIASES),
+                                                           key=len, reverse=True))))
+CODEC_RE = re.compile('|'.join(map(re.escape, sorted(CODECS, key=len, reverse=True))))
+USER_ID_RE = re.compile(r'var userid = (.+?);')
+AUTHKEY_RE = re.compile(r'var authkey = "(.+?)";')
+PASSKEY_RE = re.compile(r'passkey=(.+?)&')
+USER_LINK_RE = re.compile(r'user\.php\?id=([^&"]+)')
+# Marks form fields whose value is the path to a file to be read when uploading, rather than the content itself.
+FILE_REF = '__file_ref__'
+# Trailing IEND chunk of every PNG (zero length, chunk type and its fixed CRC).
+PNG_END = b'IEND\xaeB`\x82'
+# (connect, read) timeouts in seconds; uploads can take a while to be processed on the other end.
+REQUEST_TIMEOUT = (10, 300)
+# Shared by all requests so that connections to AHD are reused. urllib3 doesn't retry POSTs once they've been sent, so
+# retries can't cause a duplicate upload.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=8,
+                                      max_retries=Retry(total=3, backoff_factor=0.3)))
 
 
 def get_imdb_info(guessit_info):
@@ -95,16 +134,14 @@ def get_imdb_info(guessit_info):
     return IMDb().search_movie(q)[0]
 
 
-def autodetect_imdb(path, imdb_info):
-    name = Path(path).name
+def autodetect_imdb(name, imdb_info):
     g = guessit(name)
     if not imdb_info:
         imdb_info = get_imdb_info(g)
     return "tt{}".format(imdb_info.movieID), imdb_info
 
 
-def autodetect_type(path, imdb_info):
-    name = Path(path).name
+def autodetect_type(name, imdb_info):
     g = guessit(name)
     if 'season' in g:
         return 'TV-Shows', imdb_info
@@ -113,72 +150,67 @@ def autodetect_type(path, imdb_info):
     if imdb_info['kind'] == 'tv series':
         return 'TV-Shows', imdb_info
     try:
-        html = HTML(html=requests.get("https://www.imdb.com/title/tt{}".format(imdb_info.movieID)).text)
-        if 'TV Special' in html.find('.subtext')[0].html:
+        tree = lxml.html.fromstring(SESSION.get("https://www.imdb.com/title/tt{}".format(imdb_info.movieID),
+                                                 timeout=REQUEST_TIMEOUT).text)
+        if 'TV Special' in lxml.html.tostring(tree.find_class('subtext')[0], encoding='unicode'):
             return 'TV-Shows', imdb_info
     except:
         pass
     return 'Movies', imdb_info
 
 
-def autodetect_media_type(path):
-    path = Path(path)
-    if 'UHD.BluRay' in path.name:
-        return 'UHD Blu-ray'
-    if 'BluRay' in path.name:
-        return 'Blu-ray'
-    for m in MEDIA_TYPES:
-        if m in path.name:
-            return m
-    raise RuntimeError("Unable to detect media type")
-
-
-def autodetect_codec(path):
-    name = Path(path).name
+def autodetect_media_type(name):
+    m = MEDIA_TYPE_RE.search(name)
+    if not m:
+        raise RuntimeError("Unable to detect media type")
+    return MEDIA_TYPE_ALIASES.get(m.group(0), m.group(0))
+
+
+def autodetect_codec(name):
     if 'AVC' in name and 'Remux' in name:
         return 'h.264 Remux'
-    for c in CODECS:
-        if c in name:
-            return c
-    return ""
+    m = CODEC_RE.search(name)
+    return m.group(0) if m else ""
 
 
-def autodetect_group(path):
-    g = guessit(Path(path).name)
+def autodetect_group(name):
+    g = guessit(name)
     if 'release_group' in g:
         return g['release_group']
     return 'UNKNOWN'
 
 
 def preprocessing(path, arguments):
-    assert Path(path).exists()
+    path = Path(path)
+    assert path.exists()
+    name = path.name
     imdb_info = None
 
     if arguments['--imdb'] == 'AUTO-DETECT':
-        arguments['--imdb'], imdb_info = autodetect_imdb(path, imdb_info)
+        arguments['--imdb'], imdb_info = autodetect_imdb(name, imdb_info)
 
     if arguments['--type'] == 'AUTO-DETECT':
-        arguments['--type'], imdb_info = autodetect_type(path, imdb_info)
+        arguments['--type'], imdb_info = autodetect_type(name, imdb_info)
 
     if arguments['--group'] == 'AUTO-DETECT':
-        arguments['--group'] = autodetect_group(path)
+        arguments['--group'] = autodetect_group(name)
 
     if arguments['--media-type'] == 'AUTO-DETECT':
-        arguments['--media-type'] = autodetect_media_type(path)
+        arguments['--media-type'] = autodetect_media_type(name)
 
     if arguments['--codec'] == 'AUTO-DETECT':
-        arguments['--codec'] = autodetect_codec(path)
+        arguments['--codec'] = autodetect_codec(name)
         if arguments['--media-type'] == 'WEB-DL':
-            if arguments['--codec'] == 'x264' or 'H.264' in Path(path).name:
+            if arguments['--codec'] == 'x264' or 'H.264' in name:
                 arguments['--codec'] = 'h.264 Remux'
-            if arguments['--codec'] == 'x265' or 'H.265' in Path(path).name or 'HEVC' in Path(path).name:
+            if arguments['--codec'] == 'x265' or 'H.265' in name or 'HEVC' in name:
                 arguments['--codec'] = 'h.265 Remux'
 
     if arguments['--type'] == 'Movies':
-        if 'AMZN' in Path(path).name:
+        if 'AMZN' in name:
             arguments['--special-edition'] = 'Amazon'
 
-        if 'Netflix' in Path(path).name or '.NF.' in Path(path).name:
+        if 'Netflix' in name or '.NF.' in name:
             arguments['--special-edition'] = 'Netflix'
 
     assert arguments['--type'] in TYPES
@@ -189,71 +221,156 @@ def preprocessing(path, arguments):
     arguments['--num-screens'] = int(arguments['--num-screens'])
 
 
+@functools.lru_cache(maxsize=None)
+def mktorrent_supports_threads():
+    """Whether mktorrent was built with support for hashing with multiple threads (-t)."""
+    try:
+        p = subprocess.run(['mktorrent', '-h'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return False
+    return b'--threads' in p.stdout or b'-t ' in p.stdout
+
+
 def create_torrent(path, overwrite=False):
-    torrent_name = Path(path).stem
-    if Path(path).is_dir():
-        torrent_name = Path(path).name
+    path = Path(path)
+    torrent_name = path.name if path.is_dir() else path.stem
     torrent_path = Path(tempfile.gettempdir()) / ("{}.torrent".format(torrent_name))
     if torrent_path.exists():
         if not overwrite:
             return torrent_path
         torrent_path.unlink()
-    p = subprocess.run(['mktorrent', '-l', '23', '-p', '-o', str(torrent_path), str(path)],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    mktorrent_cmd = ['mktorrent', '-l', '23', '-p', '-o', str(torrent_path), str(path)]
+    if mktorrent_supports_threads():
+        mktorrent_cmd[1:1] = ['-t', str(os.cpu_count() or 1)]
+    # mktorrent reports progress on stdout and errors on stderr, so only the latter is kept.
+    p = subprocess.run(mktorrent_cmd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if p.returncode != 0:
-        raise RuntimeError("Error creating torrent: {}".format(p.stdout))
+        raise RuntimeError("Error creating torrent: {}".format(p.stderr.decode('utf-8', errors='replace')))
     return torrent_path
 
 
-def get_mediainfo(path):
-    if Path(path).is_dir():
-        path = next(Path(path).glob('*/')).as_posix()
-    return subprocess.check_output(['mediainfo', path])
+def get_representative_file(path):
+    """The file inspected for mediainfo and screenshots: the path itself, or the first regular file of a directory."""
+    path = path if isinstance(path, Path) else Path(path)
+    if not path.is_dir():
+        return path
+    try:
+        return next(p for p in sorted(path.iterdir()) if p.is_file())
+    except StopIteration:
+        raise RuntimeError("No files found directly inside {}.".format(path)) from None
 
 
-def get_duration(file):
-    args = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
-            file]
+def get_mediainfo(file, fast=False):
+    mediainfo_cmd = ['mediainfo', file]
+    if fast:
+        mediainfo_cmd.insert(1, '--ParseSpeed=0')
+    return subprocess.run(mediainfo_cmd,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+def probe_video(file):
+    args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'format=duration:stream=nb_frames,avg_frame_rate', '-of', 'json', str(file)]
     p = subprocess.run(args, stdout=subprocess.PIPE)
     if p.returncode == 127:
         raise ValueError('ffprobe is not installed or not in path.')
     if p.returncode != 0:
         raise RuntimeError('Error occurred while running ffprobe.')
-    return float(p.stdout.decode('utf-8'))
+    return json.loads(p.stdout.decode('utf-8'))
 
 
-def take_screenshot(file, offset_secs, output_dir):
-    screenshot_path = Path(output_dir) / ("{}_{}.png".format(Path(file).stem, offset_secs))
-    ffmpeg_cmd = ['ffmpeg', '-ss', str(offset_secs), '-i', str(file), '-vframes', '1', str(screenshot_path)]
+def get_duration(file):
+    probe = probe_video(file)
+    duration = probe.get('format', {}).get('duration', 'N/A')
+    if duration != 'N/A':
+        return float(duration)
+    # Some containers don't report a duration; derive it from the video stream's frame count instead.
+    try:
+        stream = probe['streams'][0]
+        frame_rate_num, frame_rate_den = stream['avg_frame_rate'].split('/')
+        return int(stream['nb_frames']) * int(frame_rate_den) / int(frame_rate_num)
+    except (KeyError, IndexError, ValueError, ZeroDivisionError):
+        raise RuntimeError('Unable to determine duration of {} using ffprobe.'.format(file)) from None
+
+
+def split_png_stream(data):
+    """Splits the output of ffmpeg's image2pipe muxer into the individual PNG images it contains."""
+    images = []
+    start = 0
+    end = data.find(PNG_END)
+    while end != -1:
+        end += len(PNG_END)
+        images.append(data[start:end])
+        start = end
+        end = data.find(PNG_END, start)
+    return images
+
+
+def take_screenshot(file, offset_secs):
+    file = file if isinstance(file, Path) else Path(file)
+    screenshot_name = "{}_{}.png".format(file.stem, offset_secs)
+    ffmpeg_cmd = ['ffmpeg', '-noaccurate_seek', '-ss', str(offset_secs), '-i', str(file), '-frames:v', '1',
+                  '-an', '-sn', '-dn', '-f', 'image2pipe', '-vcodec', 'png', 'pipe:1']
     p = subprocess.run(ffmpeg_cmd,
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     if p.returncode == 127:
         raise ValueError('ffmpeg is not installed or not in path.')
     if p.returncode != 0:
         raise RuntimeError('Error occurred while running the ffmpeg command: {}'.format(" ".join(ffmpeg_cmd)))
-    return screenshot_path
+    return screenshot_name, p.stdout
+
+
+def take_screenshots_batched(file, offsets):
+    # A single ffmpeg process with one seeked input per offset; each input still uses a fast seek, so this avoids
+    # both spawning a process per screenshot and decoding the whole file. The first frame of every input is
+    # concatenated into one stream of PNGs written to stdout, so nothing touches the disk.
+    file = file if isinstance(file, Path) else Path(file)
+    ffmpeg_cmd = ['ffmpeg']
+    for offset in offsets:
+        ffmpeg_cmd += ['-noaccurate_seek', '-ss', str(offset), '-i', str(file)]
+    filters = ["[{0}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS[v{0}]".format(i) for i in range(len(offsets))]
+    filters.append("{}concat=n={}:v=1:a=0[out]".format("".join("[v{}]".format(i) for i in range(len(offsets))),
+                                                       len(offsets)))
+    ffmpeg_cmd += ['-filter_complex', ";".join(filters), '-map', '[out]', '-vsync', '0',
+                   '-f', 'image2pipe', '-vcodec', 'png', 'pipe:1']
+    p = subprocess.run(ffmpeg_cmd,
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode == 127:
+        raise ValueError('ffmpeg is not installed or not in path.')
+    if p.returncode != 0:
+        raise RuntimeError('Error occurred while running the ffmpeg command: {}'.format(" ".join(ffmpeg_cmd)))
+    images = split_png_stream(p.stdout)
+    if len(images) != len(offsets):
+        raise RuntimeError('Expected {} screenshots from ffmpeg but got {}.'.format(len(offsets), len(images)))
+    return [("{}_{}.png".format(file.stem, offset), image) for offset, image in zip(offsets, images)]
 
 
 def take_screenshots(file, num_screens):
     duration = float(int(get_duration(file)))
-    output_dir = Path(tempfile.gettempdir()) / ("{}_screens".format(Path(file).name))
-    if output_dir.exists():
-        shutil.rmtree(output_dir.resolve())
-    Path.mkdir(output_dir)
     offsets = [int(1 / (num_screens + 1) * o * duration) for o in range(1, num_screens + 1)]
-    return [take_screenshot(file, offset, output_dir) for offset in offsets]
+    try:
+        return take_screenshots_batched(file, offsets)
+    except RuntimeError:
+        # Some ffmpeg builds choke on the batched command; fall back to one (independent) process per screenshot.
+        with ThreadPoolExecutor(max_workers=min(num_screens, os.cpu_count() or 1)) as executor:
+            return list(executor.map(lambda offset: take_screenshot(file, offset), offsets))
 
 
-def upload_screenshots(gallery_title, files, key):
+def upload_screenshots(gallery_title, screenshots, key):
     data_payload = {'apikey': key, 'galleryid': 'new', 'gallerytitle': gallery_title}
-    files_payload = [('image[]', (Path(f).name, open(f, 'rb'))) for f in files]
-    return requests.post('https://img.awesome-hd.me/api/upload', data=data_payload, files=files_payload)
+    files_payload = [('image[]', (name, image)) for name, image in screenshots]
+    return SESSION.post('https://img.awesome-hd.me/api/upload', data=data_payload, files=files_payload,
+                        timeout=REQUEST_TIMEOUT)
 
 
 def get_release_desc(path, passkey, num_screens):
-    if Path(path).is_dir():
-        path = next(Path(path).glob('*/')).as_posix()
-    r = upload_screenshots(Path(path).name, take_screenshots(path, num_screens), passkey)
+    file = get_representative_file(path)
+    return upload_release_desc(file.name, take_screenshots(file, num_screens), passkey)
+
+
+def upload_release_desc(gallery_title, screenshots, passkey):
+    r = upload_screenshots(gallery_title, screenshots, passkey)
     try:
         response_files = r.json()['files']
     except Exception as e:
@@ -261,25 +378,66 @@ def get_release_desc(path, passkey, num_screens):
     return "".join([f['bbcode'] for f in response_files])
 
 
-def get_torrent_link_from_html(html):
+def get_uploader_id(torrent_element):
+    uploader_link = torrent_element.xpath('.//a[contains(@href, "user.php?id=")]/@href')
+    if not uploader_link:
+        return None
+    return USER_LINK_RE.search(uploader_link[0]).group(1)
+
+
+def get_torrent_link_from_html(html, encoding='utf-8'):
     """Uses somewhat flimsy HTML parsing due to apparent lack of other options.
 
+    The page is parsed incrementally, so chunks of a streamed response can be passed as they arrive, and torrent rows
+    are discarded as soon as they have been read rather than kept around in a full DOM.
+
     Args:
-        html (str): string representing html of upload response.
+        html (str or iterable of bytes): html of upload response, or the chunks of bytes it's made of.
+        encoding (str): encoding of the bytes, e.g. the charset declared by the response. Ignored for str.
 
     Returns:
         str: (hopefully) direct link to torrent.
 
     """
 
-    html = HTML(html=html)
-    user_id = html.search('var userid = {};')[0]
-    authkey = html.search('var authkey = "{}";')[0]
-    passkey = html.search("passkey={}&")[0]
-    user_torrents = [t for t in html.find('[id^=torrent_]') if t.search('user.php?id={}"')[0] == user_id]
-    user_torrents_ids_and_dates = [(t.attrs['id'].split('_')[1], pendulum.from_format(t.find('span')[0].attrs['title'],
-                                                                                      'MMM DD YYYY, HH:mm')) for t in
-                                   user_torrents]
+    if isinstance(html, str):
+        html, encoding = html.encode('utf-8'), 'utf-8'
+    if isinstance(html, bytes):
+        html = [html]
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = lxml.etree.HTMLPullParser(events=('end',), encoding=encoding)
+    page_vars = {USER_ID_RE: None, AUTHKEY_RE: None, PASSKEY_RE: None}
+    torrents = []
+    text_tail = ''
+
+    def read_torrents():
+        for _, el in parser.read_events():
+            if not (el.get('id') or '').startswith('torrent_'):
+                continue
+            torrents.append((el.get('id').split('_')[1], get_uploader_id(el), el.xpath('.//span/@title')))
+            # Nested torrent_ elements are still needed by the enclosing one.
+            if not any((a.get('id') or '').startswith('torrent_') for a in el.iterancestors()):
+                el.clear()
+
+    for chunk in html:
+        # Keep the end of the previous chunk so that variables split across chunks are still found.
+        text = text_tail + decoder.decode(chunk)
+        for regex, value in page_vars.items():
+            if value is None:
+                m = regex.search(text)
+                if m:
+                    page_vars[regex] = m.group(1)
+        text_tail = text[-1024:]
+        parser.feed(chunk)
+        read_torrents()
+    parser.close()
+    read_torrents()
+
+    user_id, authkey, passkey = page_vars[USER_ID_RE], page_vars[AUTHKEY_RE], page_vars[PASSKEY_RE]
+    if None in (user_id, authkey, passkey):
+        raise RuntimeError("Unable to find user details in upload response.")
+    user_torrents_ids_and_dates = [(torrent_id, pendulum.from_format(dates[0], 'MMM DD YYYY, HH:mm'))
+                                   for torrent_id, uploader_id, dates in torrents if uploader_id == user_id]
     torrent_id, torrent_dt = max(user_torrents_ids_and_dates, key=lambda x: x[1])
     assert (pendulum.now() - torrent_dt).in_minutes() < 2
     return "https://awesome-hd.me/torrents.php?action=download&id={}&authkey={}&torrent_pass={}".format(torrent_id,
@@ -288,26 +446,38 @@ def get_torrent_link_from_html(html):
 
 
 def create_upload_form(arguments):
-    path = arguments['<media>']
+    path = Path(arguments['<media>'])
     passkey = arguments['--passkey']
 
     preprocessing(path, arguments)
-
-    torrent_path = create_torrent(path, overwrite=arguments['--overwrite-existing-torrent'])
+    # Resolved once here; get_mediainfo and take_screenshots use it as given.
+    media_file = get_representative_file(path)
+
+    # Creating the torrent, running mediainfo and taking screenshots are independent and mostly spend their time
+    # waiting on subprocesses, so they are run concurrently. If one fails, the others still run to completion before
+    # the error is raised, but the screenshots are only uploaded once all of them have succeeded.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        torrent_future = executor.submit(create_torrent, path, overwrite=arguments['--overwrite-existing-torrent'])
+        mediainfo_future = executor.submit(get_mediainfo, media_file, fast=arguments['--mediainfo-fast'])
+        screenshots_future = executor.submit(take_screenshots, media_file, arguments['--num-screens'])
+        torrent_path = torrent_future.result()
+        mediainfo = mediainfo_future.result()
+        screenshots = screenshots_future.result()
+    release_desc = upload_release_desc(media_file.name, screenshots, passkey)
 
     form = {'submit': (None, 'true'),
-            'file_input': (Path(torrent_path).name, open(torrent_path, 'rb').read()),
+            'file_input': (FILE_REF, str(torrent_path)),
             'nfo_input': (None, ""),
             'type': (None, arguments['--type']),
             'imdblink': (None, arguments['--imdb']),
             'file_media': (None, ""),
-            'pastelog': (None, get_mediainfo(path)),
+            'pastelog': (None, mediainfo),
             'group': (None, arguments['--group']),
             'remaster_title': (None, "Director's Cut"),
             'othereditions': (None, ""),
             'media': (None, arguments['--media-type']),
             'encoder': (None, arguments['--codec']),
-            'release_desc': (None, get_release_desc(path, passkey, arguments['--num-screens']))}
+            'release_desc': (None, release_desc)}
     if arguments['--group'] == 'UNKNOWN':
         form['unknown_group'] = (None, 'on')
         form['group'] = (None, '')
@@ -321,40 +491,89 @@ def create_upload_form(arguments):
         else:
             form['remaster_title'] = (None, arguments['--special-edition'])
 
-    pickle.dump(form, open(arguments['<output_form>'], 'wb'))
+    if arguments['<output_form>']:
+        save_form(form, arguments['<output_form>'])
+    return form
+
+
+def save_form(form, path):
+    fields = {}
+    for k, (filename, value) in form.items():
+        if isinstance(value, bytes):
+            fields[k] = {'filename': filename, 'value': base64.b64encode(value).decode('ascii'), 'encoding': 'base64'}
+        else:
+            fields[k] = {'filename': filename, 'value': value}
+    with open(path, 'w') as f:
+        json.dump({'fields': fields}, f, indent=2)
+
+
+def load_form(path):
+    with open(path) as f:
+        fields = json.load(f)['fields']
+    form = {}
+    for k, field in fields.items():
+        value = field['value']
+        if field.get('encoding') == 'base64':
+            value = base64.b64decode(value)
+        form[k] = (field['filename'], value)
     return form
 
 
-def upload_command(arguments):
-    assert Path(arguments['--cookies']).exists() and not Path(arguments['--cookies']).is_dir()
-    assert Path(arguments['<input_form>']).exists() and not Path(arguments['<input_form>']).is_dir()
-    r = upload_form(arguments, pickle.load(open(arguments['<input_form>'], 'rb')))
-    if r.status_code == 200:
+def upload_command(arguments, form=None):
+    """Uploads the given form, or if there isn't one, the form saved at <input_form>."""
+    assert Path(arguments['--cookies']).is_file()
+    input_form = Path(arguments['<input_form>']) if form is None else None
+    if input_form is not None:
+        assert input_form.is_file()
+        form = load_form(input_form)
+    for name, value in form.values():
+        if name == FILE_REF:
+            assert Path(value).is_file(), ("{} no longer exists (temporary files may have been cleared); "
+                                           "re-run prepare with --overwrite-existing-torrent.".format(value))
+    with closing(upload_form(arguments, form)) as r:
+        if r.status_code == 200:
+            try:
+                if arguments['--delete-on-success']:
+                    input_form.unlink()
+            except:
+                pass
+        else:
+            raise RuntimeError("Something went wrong while uploading! It's recommended to check AHD to verify that you"
+                               "haven't uploaded a malformed or incorrect torrent.")
         try:
-            if arguments['--delete-on-success']:
-                Path(arguments['<input_form>']).unlink()
+            return get_torrent_link_from_html(r.iter_content(chunk_size=64 * 1024), encoding=r.encoding or 'utf-8')
         except:
-            pass
-    else:
-        raise RuntimeError("Something went wrong while uploading! It's recommended to check AHD to verify that you"
-                           "haven't uploaded a malformed or incorrect torrent.")
-    try:
-        return get_torrent_link_from_html(r.text)
-    except:
-        return r.url
+            return r.url
 
 
-def upload_form(arguments, form):
-    cj = http.cookiejar.MozillaCookieJar(arguments['--cookies'])
+@functools.lru_cache(maxsize=4)
+def load_cookies(path, mtime):
+    """Cookies from a Netscape format file. mtime is only used as part of the cache key, to pick up changes."""
+    cj = http.cookiejar.MozillaCookieJar(path)
     cj.load()
-    return requests.post("https://awesome-hd.me/upload.php",
-                         cookies=requests.utils.dict_from_cookiejar(cj),
-                         files=form)
+    return requests.utils.dict_from_cookiejar(cj)
+
+
+def upload_form(arguments, form):
+    cookies = load_cookies(arguments['--cookies'], os.path.getmtime(arguments['--cookies']))
+    with ExitStack() as stack:
+        files = {}
+        for k, (name, value) in form.items():
+            if name == FILE_REF:
+                name, value = Path(value).name, stack.enter_context(open(value, 'rb'))
+            files[k] = (name, value)
+        return SESSION.post("https://awesome-hd.me/upload.php",
+                            cookies=cookies,
+                            files=files,
+                            timeout=REQUEST_TIMEOUT,
+                            stream=True)
 
 
 def examine_form(form):
+    torrent_is_ref = form['file_input'][0] == FILE_REF
     form = {k: v[1] for k, v in form.items()}
-    form['file_input'] = "<torrent_content>"
+    if not torrent_is_ref:
+        form['file_input'] = "<torrent_content>"
     return form
 
 
@@ -365,5 +584,7 @@ if __name__ == '__main__':
     if arguments['upload']:
         print(upload_command(arguments))
     if arguments['examine']:
-        with open(arguments['<input_form>'], 'rb') as form:
-            pprint(examine_form(pickle.load(form)))
+        pprint(examine_form(load_form(arguments['<input_form>'])))
+    if arguments['prepare-and-upload']:
+        assert Path(arguments['--cookies']).is_file()
+        print(upload_command(arguments, create_upload_form(arguments)))